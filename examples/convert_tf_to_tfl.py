@@ -0,0 +1,148 @@
+"""
+    Script for converting trained model from TensorFlow to TensorFlow Lite (with int8 post-training quantization).
+"""
+
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflowcv.model_provider import get_model as tfcv_get_model
+from tensorflowcv.model_provider import init_variables_from_state_dict
+from tensorflowcv.models.model_store import load_state_dict
+
+
+def parse_args():
+    """
+    Create python script parameters.
+
+    Returns:
+    -------
+    ArgumentParser
+        Resulted args.
+    """
+    parser = argparse.ArgumentParser(
+        description="Converting a model from TensorFlow to TensorFlow Lite",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--model",
+        type=str,
+        required=True,
+        help="type of model to use. see model_provider for options")
+    parser.add_argument(
+        "--input",
+        type=str,
+        help="path to model weights")
+    parser.add_argument(
+        "--input-shape",
+        nargs=4,
+        type=int,
+        default=(1, 224, 224, 3),
+        help="input tensor shape (NHWC)")
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="fold BatchNorm into convolutions in the model graph (DarkNet models)")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="apply int8 post-training quantization to weights and activations")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        help="path to npy file with preprocessed NHWC images for quantization calibration")
+    parser.add_argument(
+        "--calib-count",
+        type=int,
+        default=100,
+        help="number of images used for quantization calibration")
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="path to dir for output TFL file")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Main body of script.
+    """
+    args = parse_args()
+    input_shape = tuple(args.input_shape)
+
+    net_extra_kwargs = {"fused": True} if args.fused else {}
+    net = tfcv_get_model(
+        args.model,
+        pretrained=(not args.input),
+        data_format="channels_last",
+        **net_extra_kwargs)
+    x = tf.placeholder(
+        dtype=tf.float32,
+        shape=input_shape,
+        name="xx")
+    y_net = net(x)
+
+    with tf.Session() as sess:
+        if args.input:
+            init_variables_from_state_dict(
+                sess=sess,
+                state_dict=load_state_dict(file_path=args.input))
+        else:
+            init_variables_from_state_dict(sess=sess, state_dict=net.state_dict)
+
+        # Convert the model.
+        converter = tf.lite.TFLiteConverter.from_session(sess, [x], [y_net])
+
+        if args.quantize:
+            if args.dataset:
+                dataset = np.load(args.dataset).astype(np.float32)
+            else:
+                print("Calibration dataset isn't specified, random data is used (only for testing)")
+                dataset = np.random.random_sample((args.calib_count,) + input_shape[1:]).astype(np.float32)
+
+            def representative_dataset_gen():
+                for i in range(min(len(dataset), args.calib_count)):
+                    yield [dataset[i:i + 1]]
+
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset_gen
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+        tflite_model = converter.convert()
+
+        # Test the TensorFlow model on random input data.
+        input_data = np.array(np.random.random_sample(input_shape), dtype=np.float32)
+        tf_results = sess.run(y_net, feed_dict={x: input_data})
+
+    if args.output_dir is not None:
+        tfl_file_path = os.path.join(args.output_dir, "{}{}.tflite".format(
+            args.model,
+            "_int8" if args.quantize else ""))
+        open(tfl_file_path, "wb").write(tflite_model)
+
+    # Load TFLite model and allocate tensors.
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    interpreter.allocate_tensors()
+
+    # Get input and output tensors.
+    input_details = interpreter.get_input_details()
+    output_details = interpreter.get_output_details()
+
+    # Test the TensorFlow Lite model on the same input data.
+    interpreter.set_tensor(input_details[0]["index"], input_data)
+    interpreter.invoke()
+    tflite_results = interpreter.get_tensor(output_details[0]["index"])
+
+    # Compare the result.
+    if args.quantize:
+        print("Max abs difference with quantized model: {}".format(np.abs(tf_results - tflite_results).max()))
+        print("Top-1 agreement: {}".format(np.mean(tf_results.argmax(axis=1) == tflite_results.argmax(axis=1))))
+    else:
+        np.testing.assert_almost_equal(tf_results, tflite_results, decimal=5)
+
+    print("All OK.")
+
+
+if __name__ == "__main__":
+    main()
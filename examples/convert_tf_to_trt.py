@@ -0,0 +1,200 @@
+"""
+    Script for converting trained model from TensorFlow to TensorRT (TF-TRT).
+"""
+
+import os
+import hashlib
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.compiler.tensorrt import trt_convert as trt
+from tensorflowcv.model_provider import get_model as tfcv_get_model
+from tensorflowcv.model_provider import init_variables_from_state_dict
+from tensorflowcv.models.model_store import load_state_dict
+
+
+def parse_args():
+    """
+    Create python script parameters.
+
+    Returns:
+    -------
+    ArgumentParser
+        Resulted args.
+    """
+    parser = argparse.ArgumentParser(
+        description="Converting a model from TensorFlow to TensorRT",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--model",
+        type=str,
+        required=True,
+        help="type of model to use. see model_provider for options")
+    parser.add_argument(
+        "--input",
+        type=str,
+        help="path to model weights")
+    parser.add_argument(
+        "--input-shape",
+        nargs=4,
+        type=int,
+        default=(1, 224, 224, 3),
+        help="input tensor shape (NHWC or NCHW)")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="FP16",
+        choices=["FP32", "FP16"],
+        help="precision mode for TensorRT engines")
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="path to dir for output TF-TRT graph file (the dir of the weights file by default)")
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="rebuild TF-TRT graph file even if it's already cached")
+
+    args = parser.parse_args()
+    return args
+
+
+def freeze_model(model_name,
+                 input_shape,
+                 pretrained_model_file_path=None):
+    """
+    Build model graph for a static input shape and freeze its variables into constants.
+
+    Parameters:
+    ----------
+    model_name : str
+        Name of the model.
+    input_shape : tuple of 4 int
+        Input tensor shape.
+    pretrained_model_file_path : str or None, default None
+        Path to model weights (pretrained weights are downloaded if None).
+
+    Returns:
+    -------
+    GraphDef
+        Frozen graph.
+    str
+        Input tensor name.
+    str
+        Output tensor name.
+    str
+        Path to the weights file.
+    """
+    data_format = "channels_first" if input_shape[1] == 3 else "channels_last"
+    with tf.Graph().as_default() as graph:
+        net = tfcv_get_model(
+            model_name,
+            pretrained=(not pretrained_model_file_path),
+            data_format=data_format)
+        x = tf.placeholder(
+            dtype=tf.float32,
+            shape=input_shape,
+            name="xx")
+        y_net = net(x)
+
+        with tf.Session(graph=graph) as sess:
+            if pretrained_model_file_path:
+                init_variables_from_state_dict(
+                    sess=sess,
+                    state_dict=load_state_dict(file_path=pretrained_model_file_path))
+                file_path = pretrained_model_file_path
+            else:
+                init_variables_from_state_dict(sess=sess, state_dict=net.state_dict)
+                file_path = net.file_path
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                sess=sess,
+                input_graph_def=graph.as_graph_def(),
+                output_node_names=[y_net.op.name])
+
+    return graph_def, x.name, y_net.name, file_path
+
+
+def run_graph(graph_def,
+              input_name,
+              output_name,
+              input_data):
+    """
+    Run a frozen graph on the input data.
+
+    Parameters:
+    ----------
+    graph_def : GraphDef
+        Frozen graph.
+    input_name : str
+        Input tensor name.
+    output_name : str
+        Output tensor name.
+    input_data : np.array
+        Input data.
+
+    Returns:
+    -------
+    np.array
+        Output data.
+    """
+    with tf.Graph().as_default() as graph:
+        x, y = tf.import_graph_def(
+            graph_def,
+            return_elements=[input_name, output_name],
+            name="")
+        with tf.Session(graph=graph) as sess:
+            return sess.run(y, feed_dict={x: input_data})
+
+
+def main():
+    """
+    Main body of script.
+    """
+    args = parse_args()
+    input_shape = tuple(args.input_shape)
+
+    graph_def, input_name, output_name, file_path = freeze_model(
+        model_name=args.model,
+        input_shape=input_shape,
+        pretrained_model_file_path=args.input)
+
+    output_dir = args.output_dir if args.output_dir is not None else os.path.dirname(file_path)
+    with open(file_path, "rb") as f:
+        weights_sha1 = hashlib.sha1(f.read()).hexdigest()
+    trt_file_path = os.path.join(output_dir, "{}_{}-{}_{}_{}.trt.pb".format(
+        args.model,
+        os.path.basename(file_path).split(".")[0],
+        weights_sha1[:8],
+        "x".join([str(i) for i in input_shape]),
+        args.precision.lower()))
+
+    # The engines are specialized for the weights, the input shape and the precision, so they are cached for them only:
+    if os.path.exists(trt_file_path) and not args.overwrite:
+        print("Cached TF-TRT graph `{}` is used".format(trt_file_path))
+        trt_graph_def = tf.GraphDef()
+        with open(trt_file_path, "rb") as f:
+            trt_graph_def.ParseFromString(f.read())
+    else:
+        converter = trt.TrtGraphConverter(
+            input_graph_def=graph_def,
+            nodes_blacklist=[output_name.split(":")[0]],
+            max_batch_size=input_shape[0],
+            precision_mode=args.precision,
+            is_dynamic_op=False)
+        trt_graph_def = converter.convert()
+        with open(trt_file_path, "wb") as f:
+            f.write(trt_graph_def.SerializeToString())
+
+    # Test the TensorRT graph on random input data.
+    input_data = np.array(np.random.random_sample(input_shape), dtype=np.float32)
+    tf_results = run_graph(graph_def, input_name, output_name, input_data)
+    trt_results = run_graph(trt_graph_def, input_name, output_name, input_data)
+
+    # Compare the result.
+    np.testing.assert_almost_equal(tf_results, trt_results, decimal=(5 if args.precision == "FP32" else 2))
+
+    print("All OK.")
+
+
+if __name__ == "__main__":
+    main()
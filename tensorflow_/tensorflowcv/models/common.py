@@ -173,6 +173,7 @@ def flatten(x,
 def batchnorm(x,
               momentum=0.9,
               epsilon=1e-5,
+              fused=True,
               training=False,
               data_format="channels_last",
               name=None):
@@ -187,6 +188,8 @@ def batchnorm(x,
         Momentum for the moving average.
     epsilon : float, default 1e-5
         Small float added to variance to avoid dividing by zero.
+    fused : bool, default True
+        Whether to use the single-kernel fused implementation (`tf.nn.fused_batch_norm`).
     training : bool, or a TensorFlow boolean scalar tensor, default False
       Whether to return the output in training mode or in inference mode.
     data_format : str, default 'channels_last'
@@ -203,6 +206,7 @@ def batchnorm(x,
         axis=get_channel_axis(data_format),
         momentum=momentum,
         epsilon=epsilon,
+        fused=fused,
         name=name)(
         inputs=x,
         training=training)
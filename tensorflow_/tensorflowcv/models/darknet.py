@@ -7,19 +7,21 @@ __all__ = ['DarkNet', 'darknet_ref', 'darknet_tiny', 'darknet19']
 
 import os
 import tensorflow as tf
-from .common import conv2d, maxpool2d, conv1x1_block, conv3x3_block, is_channels_first, flatten
-
-
-def dark_convYxY(x,
-                 in_channels,
-                 out_channels,
-                 alpha,
-                 pointwise,
-                 training,
-                 data_format,
-                 name="dark_convYxY"):
+from .common import conv2d, conv_block, is_channels_first, get_channel_axis
+
+
+def dark_conv(x,
+              in_channels,
+              out_channels,
+              kernel_size,
+              padding,
+              alpha,
+              training,
+              fused,
+              data_format,
+              name="dark_conv"):
     """
-    DarkNet unit.
+    DarkNet specific convolution block (convolution, Batch normalization and Leaky ReLU activation).
 
     Parameters:
     ----------
@@ -29,15 +31,19 @@ def dark_convYxY(x,
         Number of input channels.
     out_channels : int
         Number of output channels.
+    kernel_size : int
+        Convolution window size.
+    padding : int
+        Padding value for convolution layer.
     alpha : float
         Slope coefficient for Leaky ReLU activation.
-    pointwise : bool
-        Whether use 1x1 (pointwise) convolution or 3x3 convolution.
     training : bool, or a TensorFlow boolean scalar tensor
       Whether to return the output in training mode or in inference mode.
+    fused : bool
+        Whether to fold Batch normalization into convolution weights in inference mode.
     data_format : str
         The ordering of the dimensions in tensors.
-    name : str, default 'dark_convYxY'
+    name : str, default 'dark_conv'
         Block name.
 
     Returns:
@@ -45,25 +51,165 @@ def dark_convYxY(x,
     Tensor
         Resulted tensor.
     """
-    if pointwise:
-        return conv1x1_block(
-            x=x,
-            in_channels=in_channels,
-            out_channels=out_channels,
-            activation=(lambda y: tf.nn.leaky_relu(y, alpha=alpha, name=name + "/activ")),
-            training=training,
-            data_format=data_format,
-            name=name)
-    else:
-        return conv3x3_block(
+    if not (fused and (training is False)):
+        return conv_block(
             x=x,
             in_channels=in_channels,
             out_channels=out_channels,
+            kernel_size=kernel_size,
+            strides=1,
+            padding=padding,
             activation=(lambda y: tf.nn.leaky_relu(y, alpha=alpha, name=name + "/activ")),
             training=training,
             data_format=data_format,
             name=name)
 
+    if padding > 0:
+        if is_channels_first(data_format):
+            paddings_tf = [[0, 0], [0, 0], [padding] * 2, [padding] * 2]
+        else:
+            paddings_tf = [[0, 0], [padding] * 2, [padding] * 2, [0, 0]]
+        x = tf.pad(x, paddings=paddings_tf)
+
+    # The same Keras layers as in `conv_block` hold the variables, so they get the same names and scoping (and the
+    # same state dict can be loaded into both graphs). The layers are only built (under the same name scopes as in
+    # their calls), so they don't add their own ops to the graph:
+    conv = tf.keras.layers.Conv2D(
+        filters=out_channels,
+        kernel_size=kernel_size,
+        padding="valid",
+        data_format=data_format,
+        use_bias=False,
+        kernel_initializer=tf.keras.initializers.VarianceScaling(2.0),
+        name=name + "/conv")
+    with tf.compat.v1.name_scope(conv.name):
+        conv.build(x.shape)
+    bn = tf.keras.layers.BatchNormalization(
+        axis=get_channel_axis(data_format),
+        momentum=0.9,
+        epsilon=1e-5,
+        name=name + "/bn")
+    with tf.compat.v1.name_scope(bn.name):
+        bn.build(tf.TensorShape((None, out_channels, None, None) if is_channels_first(data_format) else
+                                (None, None, None, out_channels)))
+
+    # The folding itself is done in float32, only the resulted weights follow the input precision:
+    scale = bn.gamma * tf.math.rsqrt(bn.moving_variance + bn.epsilon)
+    kernel = tf.cast(conv.kernel * scale, dtype=x.dtype)
+    bias = tf.cast(bn.beta - bn.moving_mean * scale, dtype=x.dtype)
+
+    tf_data_format = "NCHW" if is_channels_first(data_format) else "NHWC"
+    x = tf.nn.conv2d(
+        x,
+        filter=kernel,
+        strides=(1, 1, 1, 1),
+        padding="VALID",
+        data_format=tf_data_format,
+        name=name + "/fused_conv")
+    x = tf.nn.bias_add(
+        x,
+        bias=bias,
+        data_format=tf_data_format,
+        name=name + "/fused_bias")
+    x = tf.nn.leaky_relu(x, alpha=alpha, name=name + "/activ")
+    return x
+
+
+def dark_conv1x1(x,
+                 in_channels,
+                 out_channels,
+                 alpha,
+                 training,
+                 fused,
+                 data_format,
+                 name="dark_conv1x1"):
+    """
+    1x1 version of the DarkNet specific convolution block.
+
+    Parameters:
+    ----------
+    x : Tensor
+        Input tensor.
+    in_channels : int
+        Number of input channels.
+    out_channels : int
+        Number of output channels.
+    alpha : float
+        Slope coefficient for Leaky ReLU activation.
+    training : bool, or a TensorFlow boolean scalar tensor
+      Whether to return the output in training mode or in inference mode.
+    fused : bool
+        Whether to fold Batch normalization into convolution weights in inference mode.
+    data_format : str
+        The ordering of the dimensions in tensors.
+    name : str, default 'dark_conv1x1'
+        Block name.
+
+    Returns:
+    -------
+    Tensor
+        Resulted tensor.
+    """
+    return dark_conv(
+        x=x,
+        in_channels=in_channels,
+        out_channels=out_channels,
+        kernel_size=1,
+        padding=0,
+        alpha=alpha,
+        training=training,
+        fused=fused,
+        data_format=data_format,
+        name=name)
+
+
+def dark_conv3x3(x,
+                 in_channels,
+                 out_channels,
+                 alpha,
+                 training,
+                 fused,
+                 data_format,
+                 name="dark_conv3x3"):
+    """
+    3x3 version of the DarkNet specific convolution block.
+
+    Parameters:
+    ----------
+    x : Tensor
+        Input tensor.
+    in_channels : int
+        Number of input channels.
+    out_channels : int
+        Number of output channels.
+    alpha : float
+        Slope coefficient for Leaky ReLU activation.
+    training : bool, or a TensorFlow boolean scalar tensor
+      Whether to return the output in training mode or in inference mode.
+    fused : bool
+        Whether to fold Batch normalization into convolution weights in inference mode.
+    data_format : str
+        The ordering of the dimensions in tensors.
+    name : str, default 'dark_conv3x3'
+        Block name.
+
+    Returns:
+    -------
+    Tensor
+        Resulted tensor.
+    """
+    return dark_conv(
+        x=x,
+        in_channels=in_channels,
+        out_channels=out_channels,
+        kernel_size=3,
+        padding=1,
+        alpha=alpha,
+        training=training,
+        fused=fused,
+        data_format=data_format,
+        name=name)
+
 
 class DarkNet(object):
     """
@@ -81,6 +227,18 @@ class DarkNet(object):
         Whether classification convolution layer uses an activation.
     alpha : float, default 0.1
         Slope coefficient for Leaky ReLU activation.
+    fused : bool, default False
+        Whether to fold Batch normalization into convolution weights in inference mode.
+    jit : bool, default False
+        Whether to compile the model graph with XLA (the input should have a fully defined shape).
+    dtype : str, default 'float32'
+        Data type of the feature extractor computations ('float16' is only supported with `fused` in inference mode).
+    freeze : bool, default False
+        Whether to build an inference graph with the model variables frozen into constants (the input should have a
+        fully defined shape). The weights are taken from `freeze_weights` or the pretrained state dict at graph
+        creation, so weights loaded into a session after the graph is built are ignored.
+    freeze_weights : dict or str or None, default None
+        State dict (or path to the file with it) to freeze the weights from (the pretrained state dict if None).
     in_channels : int, default 3
         Number of input channels.
     in_size : tuple of two ints, default (224, 224)
@@ -89,6 +247,8 @@ class DarkNet(object):
         Number of classification classes.
     data_format : str, default 'channels_last'
         The ordering of the dimensions in tensors.
+    in_data_format : str or None, default None
+        The ordering of the dimensions in the input tensor (the same as `data_format` if None).
     """
     def __init__(self,
                  channels,
@@ -96,22 +256,41 @@ class DarkNet(object):
                  avg_pool_size,
                  cls_activ,
                  alpha=0.1,
+                 fused=False,
+                 jit=False,
+                 dtype="float32",
+                 freeze=False,
+                 freeze_weights=None,
                  in_channels=3,
                  in_size=(224, 224),
                  classes=1000,
                  data_format="channels_last",
+                 in_data_format=None,
                  **kwargs):
         super(DarkNet, self).__init__(**kwargs)
         assert (data_format in ["channels_last", "channels_first"])
+        assert (in_data_format in [None, "channels_last", "channels_first"])
+        assert (dtype in ["float32", "float16"])
+        assert (dtype == "float32") or fused
         self.channels = channels
         self.odd_pointwise = odd_pointwise
+        self.units = [[(dark_conv1x1 if (len(channels_per_stage) > 1) and not (((j + 1) % 2 == 1) ^ odd_pointwise)
+                        else dark_conv3x3) for j in range(len(channels_per_stage))]
+                      for channels_per_stage in channels]
         self.avg_pool_size = avg_pool_size
         self.cls_activ = cls_activ
         self.alpha = alpha
+        self.fused = fused
+        self.jit = jit
+        self.dtype = dtype
+        self.freeze = freeze
+        self.freeze_weights = freeze_weights
+        self.state_dict = None
         self.in_channels = in_channels
         self.in_size = in_size
         self.classes = classes
         self.data_format = data_format
+        self.in_data_format = in_data_format if in_data_format is not None else data_format
 
     def __call__(self,
                  x,
@@ -131,27 +310,141 @@ class DarkNet(object):
         Tensor
             Resulted tensor.
         """
+        if self.freeze:
+            assert (training is False)
+            return self._build_frozen(x=x)
+        return self._build_scoped(x=x, training=training)
+
+    def _build_frozen(self,
+                      x):
+        """
+        Build an inference model graph with frozen weights. The graph is built and frozen in a private graph, and then
+        imported into the caller's graph with the private input placeholder mapped to `x`.
+
+        Parameters:
+        ----------
+        x : Tensor
+            Input tensor (in the caller's graph).
+
+        Returns:
+        -------
+        Tensor
+            Resulted tensor (in the caller's graph).
+        """
+        state_dict = self.freeze_weights if self.freeze_weights is not None else self.state_dict
+        if state_dict is None:
+            raise ValueError("Frozen model graph requires weights: use `pretrained` or `freeze_weights` parameter.")
+        if isinstance(state_dict, str):
+            from .model_store import load_state_dict
+            state_dict = load_state_dict(file_path=state_dict)
+
+        with tf.Graph().as_default() as graph:
+            src_x = tf.compat.v1.placeholder(
+                dtype=x.dtype,
+                shape=x.shape,
+                name="xx")
+            src_y = self._build_scoped(x=src_x, training=False)
+            missing_keys = [v.name for v in tf.compat.v1.global_variables() if v.name not in state_dict]
+            if missing_keys:
+                raise ValueError("The state dict for frozen model graph misses keys: {}".format(missing_keys))
+            with tf.compat.v1.Session(graph=graph) as sess:
+                from .model_store import init_variables_from_state_dict
+                init_variables_from_state_dict(sess=sess, state_dict=state_dict)
+                graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                    sess=sess,
+                    input_graph_def=graph.as_graph_def(),
+                    output_node_names=[src_y.op.name])
+        y = tf.import_graph_def(
+            graph_def,
+            input_map={src_x.name: x},
+            return_elements=[src_y.name],
+            name="")[0]
+        return y
+
+    def _build_scoped(self,
+                      x,
+                      training):
+        """
+        Build a model graph, within the XLA compilation scope if required.
+
+        Parameters:
+        ----------
+        x : Tensor
+            Input tensor.
+        training : bool, or a TensorFlow boolean scalar tensor
+          Whether to return the output in training mode or in inference mode.
+
+        Returns:
+        -------
+        Tensor
+            Resulted tensor.
+        """
+        if self.jit:
+            with tf.xla.experimental.jit_scope():
+                return self._build(x=x, training=training)
+        return self._build(x=x, training=training)
+
+    def _build(self,
+               x,
+               training):
+        """
+        Build a model graph (the body of the model).
+
+        Parameters:
+        ----------
+        x : Tensor
+            Input tensor.
+        training : bool, or a TensorFlow boolean scalar tensor
+          Whether to return the output in training mode or in inference mode.
+
+        Returns:
+        -------
+        Tensor
+            Resulted tensor.
+        """
+        if self.in_data_format != self.data_format:
+            # The only layout transpose in the graph, the output is flattened from a 1x1 map and needs no inverse one:
+            x = tf.transpose(
+                x,
+                perm=((0, 3, 1, 2) if is_channels_first(self.data_format) else (0, 2, 3, 1)),
+                name="features/transpose")
+        if self.dtype != "float32":
+            assert (training is False)
+            x = tf.cast(x, dtype=self.dtype)
+
         in_channels = self.in_channels
-        for i, channels_per_stage in enumerate(self.channels):
-            for j, out_channels in enumerate(channels_per_stage):
-                x = dark_convYxY(
+        for i, (channels_per_stage, units_per_stage) in enumerate(zip(self.channels, self.units)):
+            for j, (out_channels, unit) in enumerate(zip(channels_per_stage, units_per_stage)):
+                x = unit(
                     x=x,
                     in_channels=in_channels,
                     out_channels=out_channels,
                     alpha=self.alpha,
-                    pointwise=(len(channels_per_stage) > 1) and not (((j + 1) % 2 == 1) ^ self.odd_pointwise),
                     training=training,
+                    fused=self.fused,
                     data_format=self.data_format,
                     name="features/stage{}/unit{}".format(i + 1, j + 1))
                 in_channels = out_channels
             if i != len(self.channels) - 1:
-                x = maxpool2d(
-                    x=x,
-                    pool_size=2,
-                    strides=2,
-                    data_format=self.data_format,
+                x = tf.nn.max_pool(
+                    x,
+                    ksize=((1, 1, 2, 2) if is_channels_first(self.data_format) else (1, 2, 2, 1)),
+                    strides=((1, 1, 2, 2) if is_channels_first(self.data_format) else (1, 2, 2, 1)),
+                    padding="VALID",
+                    data_format=("NCHW" if is_channels_first(self.data_format) else "NHWC"),
                     name="features/pool{}".format(i + 1))
+        if self.dtype != "float32":
+            x = tf.cast(x, dtype=tf.float32)
 
+        final_pool = tf.keras.layers.AveragePooling2D(
+            pool_size=self.avg_pool_size,
+            strides=1,
+            data_format=self.data_format,
+            name="output/final_pool")
+        if not self.cls_activ:
+            # Without the activation the classification convolution is linear and commutes with average pooling, so
+            # it is cheaper to pool first:
+            x = final_pool(x)
         x = conv2d(
             x=x,
             in_channels=in_channels,
@@ -161,19 +454,25 @@ class DarkNet(object):
             name="output/final_conv")
         if self.cls_activ:
             x = tf.nn.leaky_relu(x, alpha=self.alpha, name="output/final_activ")
-        x = tf.keras.layers.AveragePooling2D(
-            pool_size=self.avg_pool_size,
-            strides=1,
-            data_format=self.data_format,
-            name="output/final_pool")(x)
-        # x = tf.layers.flatten(x)
-        x = flatten(
-            x=x,
-            data_format=self.data_format)
+            x = final_pool(x)
+        # The final pooling should leave a 1x1 spatial map (for the expected input size), so the layout transpose in
+        # `flatten` is not needed:
+        spatial_shape = x.shape.as_list()[2:] if is_channels_first(self.data_format) else x.shape.as_list()[1:3]
+        assert all((size is None) or (size == 1) for size in spatial_shape)
+        x = tf.reshape(x, shape=(-1, self.classes), name="output/flatten")
 
         return x
 
 
+# DarkNet configurations for each version: channels, odd_pointwise, avg_pool_size, cls_activ.
+_darknet_configs = {
+    'ref': (((16,), (32,), (64,), (128,), (256,), (512,), (1024,)), False, 3, True),
+    'tiny': (((16,), (32,), (16, 128, 16, 128), (32, 256, 32, 256), (64, 512, 64, 512, 128)), True, 14, False),
+    '19': (((32,), (64,), (128, 64, 128), (256, 128, 256), (512, 256, 512, 256, 512), (1024, 512, 1024, 512, 1024)),
+           False, 7, False),
+}
+
+
 def get_darknet(version,
                 model_name=None,
                 pretrained=False,
@@ -199,24 +498,9 @@ def get_darknet(version,
         Functor for model graph creation with extra fields.
     """
 
-    if version == 'ref':
-        channels = [[16], [32], [64], [128], [256], [512], [1024]]
-        odd_pointwise = False
-        avg_pool_size = 3
-        cls_activ = True
-    elif version == 'tiny':
-        channels = [[16], [32], [16, 128, 16, 128], [32, 256, 32, 256], [64, 512, 64, 512, 128]]
-        odd_pointwise = True
-        avg_pool_size = 14
-        cls_activ = False
-    elif version == '19':
-        channels = [[32], [64], [128, 64, 128], [256, 128, 256], [512, 256, 512, 256, 512],
-                    [1024, 512, 1024, 512, 1024]]
-        odd_pointwise = False
-        avg_pool_size = 7
-        cls_activ = False
-    else:
+    if version not in _darknet_configs:
         raise ValueError("Unsupported DarkNet version {}".format(version))
+    channels, odd_pointwise, avg_pool_size, cls_activ = _darknet_configs[version]
 
     net = DarkNet(
         channels=channels,
@@ -310,28 +594,64 @@ def _test():
 
     for model in models:
 
-        net = model(pretrained=pretrained, data_format=data_format)
+        # The folded graph is checked against the ordinary one on the same weights (with random BatchNorm statistics):
+        state_dict = None
+        y_ref = None
+        x_value = np.random.rand(*((1, 3, 224, 224) if is_channels_first(data_format) else (1, 224, 224, 3)))
+        x_value = x_value.astype(np.float32)
+
+        for fused in [False, True]:
+            net = model(pretrained=pretrained, data_format=data_format, fused=fused)
+            x = tf.placeholder(
+                dtype=tf.float32,
+                shape=(None, 3, 224, 224) if is_channels_first(data_format) else (None, 224, 224, 3),
+                name="xx")
+            y_net = net(x)
+
+            weight_count = sum(v.shape.num_elements() for v in tf.trainable_variables())
+            print("m={}, fused={}, {}".format(model.__name__, fused, weight_count))
+            assert (model != darknet_ref or weight_count == 7319416)
+            assert (model != darknet_tiny or weight_count == 1042104)
+            assert (model != darknet19 or weight_count == 20842376)
+
+            # The folded graph should have exactly the same variables, as well as no extra ops for them:
+            assert (state_dict is None) or (set(state_dict.keys()) == set(v.name for v in tf.global_variables()))
+            if fused:
+                feature_ops = [op for op in tf.get_default_graph().get_operations() if op.name.startswith("features/")]
+                assert (len([op for op in feature_ops if op.type == "Conv2D"]) == sum(len(c) for c in net.channels))
+                assert not any(op.type.startswith("FusedBatchNorm") for op in feature_ops)
+
+            with tf.Session() as sess:
+                from .model_store import init_variables_from_state_dict
+                if state_dict is not None:
+                    init_variables_from_state_dict(sess=sess, state_dict=state_dict)
+                elif pretrained:
+                    init_variables_from_state_dict(sess=sess, state_dict=net.state_dict)
+                else:
+                    sess.run(tf.global_variables_initializer())
+                    for v in tf.global_variables():
+                        if "/bn/" in v.name:
+                            low, high = (0.5, 1.5) if ("gamma" in v.name or "variance" in v.name) else (-0.5, 0.5)
+                            sess.run(v.assign(np.random.uniform(low, high, size=v.shape.as_list()).astype(np.float32)))
+                state_dict = {v.name: v.eval(sess) for v in tf.global_variables()}
+                y = sess.run(y_net, feed_dict={x: x_value})
+                assert (y.shape == (1, 1000))
+                if y_ref is None:
+                    y_ref = y
+                else:
+                    assert np.allclose(y, y_ref, rtol=1e-4, atol=1e-5)
+            tf.reset_default_graph()
+
+        net = model(pretrained=pretrained, data_format=data_format, fused=True, freeze=True, freeze_weights=state_dict)
         x = tf.placeholder(
             dtype=tf.float32,
-            shape=(None, 3, 224, 224) if is_channels_first(data_format) else (None, 224, 224, 3),
+            shape=x_value.shape,
             name="xx")
         y_net = net(x)
-
-        weight_count = np.sum([np.prod(v.get_shape().as_list()) for v in tf.trainable_variables()])
-        print("m={}, {}".format(model.__name__, weight_count))
-        assert (model != darknet_ref or weight_count == 7319416)
-        assert (model != darknet_tiny or weight_count == 1042104)
-        assert (model != darknet19 or weight_count == 20842376)
-
+        assert (len(tf.global_variables()) == 0)
         with tf.Session() as sess:
-            if pretrained:
-                from .model_store import init_variables_from_state_dict
-                init_variables_from_state_dict(sess=sess, state_dict=net.state_dict)
-            else:
-                sess.run(tf.global_variables_initializer())
-            x_value = np.zeros((1, 3, 224, 224) if is_channels_first(data_format) else (1, 224, 224, 3), np.float32)
             y = sess.run(y_net, feed_dict={x: x_value})
-            assert (y.shape == (1, 1000))
+            assert np.allclose(y, y_ref, rtol=1e-4, atol=1e-5)
         tf.reset_default_graph()
 
 